@@ -0,0 +1,294 @@
+"""
+Fałszywy serwer RFB 3.8 do testów wydajności ścieżki VNC bez prawdziwych płytek.
+
+Serwer wysyła syntetyczne aktualizacje ekranu o zadanej rozdzielczości,
+kodowaniu i częstotliwości zmian. Może nasłuchiwać bezpośrednio na TCP
+(jak serwer VNC) oraz na WebSocket (jak websockify).
+
+Uruchom: python fake_rfb_server.py --port 5900 --websocket-port 6080
+"""
+import argparse
+import asyncio
+import logging
+import math
+import random
+import struct
+import zlib
+from typing import List, Optional, Tuple
+
+import rfb_protocol as rfb
+
+logger = logging.getLogger(__name__)
+
+TILE_SIZE = 64
+
+Rect = Tuple[int, int, int, int]
+
+
+class SyntheticFramebuffer:
+    """
+    Two precomputed screen images shared by every connection.
+
+    Changed tiles alternate between the two images, so each update carries
+    pixels that really differ from the previous frame while the server keeps
+    a constant memory footprint regardless of the number of clients.
+    """
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+        self.stride = width * rfb.BYTES_PER_PIXEL
+        self.images = [self._build_image(variant) for variant in range(2)]
+
+    def _build_image(self, variant: int) -> bytes:
+        base_row = bytes(
+            (x * (3 + variant) + variant * 85 + (x >> 4) * 7) & 0xFF
+            for x in range(self.stride)
+        )
+        rows = []
+        for y in range(self.height):
+            offset = (y * (5 + variant * 4)) % self.stride
+            rows.append(base_row[offset:] + base_row[:offset])
+        return b"".join(rows)
+
+    def pixels(self, variant: int, rect: Rect) -> bytes:
+        x, y, w, h = rect
+        image = self.images[variant % 2]
+        start = x * rfb.BYTES_PER_PIXEL
+        end = start + w * rfb.BYTES_PER_PIXEL
+        return b"".join(
+            image[row * self.stride + start:row * self.stride + end]
+            for row in range(y, y + h)
+        )
+
+    def tiles(self) -> List[Rect]:
+        result = []
+        for y in range(0, self.height, TILE_SIZE):
+            for x in range(0, self.width, TILE_SIZE):
+                result.append((x, y, min(TILE_SIZE, self.width - x), min(TILE_SIZE, self.height - y)))
+        return result
+
+
+class FakeRFBSession:
+    """One client connection speaking RFB 3.8 with security type None."""
+
+    def __init__(self, server: "FakeRFBServer", stream):
+        self.server = server
+        self.stream = stream
+        self.encoding = rfb.ENCODING_RAW
+        self.frame = 0
+        self.rng = random.Random(server.seed)
+        self.zlib_stream = zlib.compressobj()
+        self.pending: Optional[bool] = None  # None = no request, else "incremental"
+        self.request_event = asyncio.Event()
+        self.last_update = 0.0
+
+    async def run(self):
+        try:
+            await self._handshake()
+            sender = asyncio.ensure_future(self._send_updates())
+            try:
+                await self._read_messages()
+            finally:
+                sender.cancel()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        except Exception as e:
+            if not self.server.is_connection_closed(e):
+                logger.exception("Fake RFB session failed")
+        finally:
+            await self.stream.close()
+
+    async def _handshake(self):
+        await self.stream.write(rfb.PROTOCOL_VERSION)
+        await self.stream.readexactly(12)
+        await self.stream.write(struct.pack(">BB", 1, rfb.SECURITY_NONE))
+        await self.stream.readexactly(1)
+        await self.stream.write(struct.pack(">I", 0))
+        await self.stream.readexactly(1)  # ClientInit shared flag
+        fb = self.server.framebuffer
+        await self.stream.write(rfb.pack_server_init(fb.width, fb.height, self.server.name))
+
+    async def _read_messages(self):
+        while True:
+            message_type = (await self.stream.readexactly(1))[0]
+            if message_type == rfb.CLIENT_SET_ENCODINGS:
+                _, count = struct.unpack(">BH", await self.stream.readexactly(3))
+                data = await self.stream.readexactly(4 * count)
+                offered = struct.unpack(">%di" % count, data)
+                self.encoding = self.server.encoding if self.server.encoding in offered else rfb.ENCODING_RAW
+            elif message_type == rfb.CLIENT_CUT_TEXT:
+                _, length = struct.unpack(">3sI", await self.stream.readexactly(7))
+                await self.stream.readexactly(length)
+            elif message_type in rfb.CLIENT_MESSAGE_SIZES:
+                data = await self.stream.readexactly(rfb.CLIENT_MESSAGE_SIZES[message_type] - 1)
+                if message_type == rfb.CLIENT_FRAMEBUFFER_UPDATE_REQUEST:
+                    incremental = bool(data[0])
+                    # A full refresh wins over any incremental request still pending
+                    self.pending = incremental if self.pending is None else (self.pending and incremental)
+                    self.request_event.set()
+            else:
+                raise ConnectionError(f"Unsupported client message type {message_type}")
+
+    async def _send_updates(self):
+        loop = asyncio.get_running_loop()
+        fb = self.server.framebuffer
+        while True:
+            await self.request_event.wait()
+            self.request_event.clear()
+            incremental, self.pending = self.pending, None
+            if incremental:
+                if self.server.interval:
+                    delay = self.last_update + self.server.interval - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                rects = self._changed_tiles()
+            else:
+                rects = [(0, 0, fb.width, fb.height)]
+            self.last_update = loop.time()
+            self.frame += 1
+            await self.stream.write(self._encode_update(rects))
+
+    def _changed_tiles(self) -> List[Rect]:
+        tiles = self.server.tiles
+        count = max(1, math.ceil(len(tiles) * self.server.change))
+        return self.rng.sample(tiles, min(count, len(tiles)))
+
+    def _encode_update(self, rects: List[Rect]) -> bytes:
+        parts = [struct.pack(">BxH", rfb.SERVER_FRAMEBUFFER_UPDATE, len(rects))]
+        for rect in rects:
+            parts.append(struct.pack(">HHHHi", *rect, self.encoding))
+            parts.append(self._encode_rect(rect))
+        return b"".join(parts)
+
+    def _encode_rect(self, rect: Rect) -> bytes:
+        fb = self.server.framebuffer
+        if self.encoding == rfb.ENCODING_RRE:
+            _, _, w, h = rect
+            background = fb.pixels(self.frame, (rect[0], rect[1], 1, 1))
+            foreground = fb.pixels(self.frame + 1, (rect[0], rect[1], 1, 1))
+            return struct.pack(">I", 1) + background + foreground + \
+                struct.pack(">HHHH", w // 4, h // 4, max(1, w // 2), max(1, h // 2))
+        pixels = fb.pixels(self.frame, rect)
+        if self.encoding == rfb.ENCODING_ZLIB:
+            data = self.zlib_stream.compress(pixels) + self.zlib_stream.flush(zlib.Z_SYNC_FLUSH)
+            return struct.pack(">I", len(data)) + data
+        return pixels
+
+
+class FakeRFBServer:
+    """
+    Scriptable fake RFB server.
+
+    ``change`` is the fraction of the screen (in 64x64 tiles) repainted in
+    every incremental update and ``fps`` caps how often a single client gets
+    one; ``fps=0`` answers each update request immediately.
+    """
+
+    def __init__(
+        self,
+        width: int = 1024,
+        height: int = 768,
+        encoding: str = "raw",
+        fps: float = 30.0,
+        change: float = 0.1,
+        seed: int = 0,
+        name: str = "U-Boot VNC fake RFB",
+    ):
+        if encoding not in ("raw", "rre", "zlib"):
+            raise ValueError(f"Unsupported encoding: {encoding}")
+        if not 0 < change <= 1:
+            raise ValueError("change must be in (0, 1]")
+        self.framebuffer = SyntheticFramebuffer(width, height)
+        self.tiles = self.framebuffer.tiles()
+        self.encoding = rfb.ENCODINGS[encoding]
+        self.interval = 1.0 / fps if fps > 0 else 0.0
+        self.change = change
+        self.seed = seed
+        self.name = name
+        self._servers = []
+
+    async def start_tcp(self, host: str, port: int):
+        async def handle(reader, writer):
+            await FakeRFBSession(self, rfb.TCPStream(reader, writer)).run()
+
+        server = await asyncio.start_server(handle, host, port)
+        self._servers.append(server)
+        logger.info(f"Fake RFB server listening on {host}:{server.sockets[0].getsockname()[1]}")
+        return server
+
+    async def start_websocket(self, host: str, port: int):
+        import websockets
+
+        async def handle(websocket):
+            await FakeRFBSession(self, rfb.WebSocketStream(websocket)).run()
+
+        # Mimic websockify: binary subprotocol, no permessage-deflate
+        server = await websockets.serve(
+            handle, host, port, subprotocols=["binary"], compression=None, max_size=None
+        )
+        self._servers.append(server)
+        logger.info(f"Fake RFB WebSocket server listening on ws://{host}:{port}/websockify")
+        return server
+
+    @staticmethod
+    def is_connection_closed(error: Exception) -> bool:
+        try:
+            import websockets
+        except ImportError:
+            return False
+        return isinstance(error, websockets.ConnectionClosed)
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        self._servers = []
+
+
+async def _main(args):
+    server = FakeRFBServer(
+        width=args.width,
+        height=args.height,
+        encoding=args.encoding,
+        fps=args.fps,
+        change=args.change,
+        seed=args.seed,
+    )
+    if args.port:
+        await server.start_tcp(args.host, args.port)
+    if args.websocket_port:
+        await server.start_websocket(args.host, args.websocket_port)
+    try:
+        if args.duration:
+            await asyncio.sleep(args.duration)
+        else:
+            await asyncio.Event().wait()
+    finally:
+        await server.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fałszywy serwer RFB 3.8 z syntetycznym obrazem")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5900, help="port TCP (0 = wyłączony)")
+    parser.add_argument("--websocket-port", type=int, default=0, help="port WebSocket (0 = wyłączony)")
+    parser.add_argument("--width", type=int, default=1024)
+    parser.add_argument("--height", type=int, default=768)
+    parser.add_argument("--encoding", choices=["raw", "rre", "zlib"], default="raw")
+    parser.add_argument("--fps", type=float, default=30.0, help="maks. liczba aktualizacji/s na klienta (0 = bez limitu)")
+    parser.add_argument("--change", type=float, default=0.1, help="część ekranu zmieniana w każdej aktualizacji")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--duration", type=float, default=0, help="zakończ po N sekundach (0 = bez końca)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logging.getLogger("websockets").setLevel(logging.WARNING)
+    try:
+        asyncio.run(_main(args))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,8 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, WebSocket, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 from datetime import datetime, timedelta
 from typing import List, Optional
 import uvicorn
@@ -15,12 +16,14 @@ from models import User, VNCMachine
 from schemas import (
     UserCreate, UserResponse, UserUpdate,
     VNCMachineCreate, VNCMachineUpdate, VNCMachineResponse,
-    Token, TokenData
+    RelaySessionStats, Token, TokenData
 )
 from auth import (
     get_password_hash, verify_password, create_access_token,
     get_current_user, get_current_admin_user
 )
+from ws_resolver import allowed_target, resolver
+import vnc_relay
 
 # Create tables
 Base.metadata.create_all(bind=engine)
@@ -119,6 +122,20 @@ def get_db():
         db.close()
 
 
+def with_ws_endpoints(machines: List[VNCMachine], refresh: bool = False) -> List[VNCMachineResponse]:
+    """Attach the resolved WebSocket endpoint to each machine response"""
+    if refresh:
+        for machine in machines:
+            resolver.refresh(machine.url)
+    endpoints = resolver.resolve_many(machine.url for machine in machines)
+    responses = []
+    for machine in machines:
+        response = VNCMachineResponse.model_validate(machine)
+        response.ws_url = endpoints[machine.url]
+        responses.append(response)
+    return responses
+
+
 # Auth endpoints
 @app.post("/api/auth/register", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
 def register(user: UserCreate, db: Session = Depends(get_db)):
@@ -252,7 +269,7 @@ def get_machines(
     machines = db.query(VNCMachine).filter(
         (VNCMachine.is_shared == True) | (VNCMachine.owner_id == current_user.id)
     ).all()
-    return machines
+    return with_ws_endpoints(machines)
 
 
 @app.get("/api/machines/admin", response_model=List[VNCMachineResponse])
@@ -261,7 +278,7 @@ def get_admin_machines(
     db: Session = Depends(get_db)
 ):
     machines = db.query(VNCMachine).filter(VNCMachine.is_shared == True).all()
-    return machines
+    return with_ws_endpoints(machines)
 
 
 @app.post("/api/machines", response_model=VNCMachineResponse, status_code=status.HTTP_201_CREATED)
@@ -280,7 +297,7 @@ def create_machine(
     db.add(db_machine)
     db.commit()
     db.refresh(db_machine)
-    return db_machine
+    return with_ws_endpoints([db_machine])[0]
 
 
 @app.put("/api/machines/{machine_id}", response_model=VNCMachineResponse)
@@ -309,7 +326,7 @@ def update_machine(
     
     db.commit()
     db.refresh(db_machine)
-    return db_machine
+    return with_ws_endpoints([db_machine])[0]
 
 
 @app.delete("/api/machines/{machine_id}")
@@ -345,7 +362,106 @@ def get_machine(
     if not db_machine.is_shared and db_machine.owner_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not enough permissions")
     
-    return db_machine
+    return with_ws_endpoints([db_machine])[0]
+
+
+@app.post("/api/machines/{machine_id}/ws-endpoint/refresh", response_model=VNCMachineResponse)
+def refresh_machine_ws_endpoint(
+    machine_id: int,
+    current_user: User = Depends(get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Re-probe the WebSocket endpoint after the viewer failed to connect to it (throttled per URL)"""
+    db_machine = db.query(VNCMachine).filter(VNCMachine.id == machine_id).first()
+    if not db_machine:
+        raise HTTPException(status_code=404, detail="Machine not found")
+    
+    # Check permissions
+    if not db_machine.is_shared and db_machine.owner_id != current_user.id:
+        raise HTTPException(status_code=403, detail="Not enough permissions")
+    
+    return with_ws_endpoints([db_machine], refresh=True)[0]
+
+
+@app.websocket("/api/machines/{machine_id}/relay")
+async def relay_machine(websocket: WebSocket, machine_id: int):
+    """
+    Relay a VNC session through the backend. The JWT comes as a
+    Sec-WebSocket-Protocol entry, see ``vnc_relay.TOKEN_SUBPROTOCOL_PREFIX``.
+    """
+    logger = logging.getLogger(__name__)
+    subprotocols = websocket.scope.get("subprotocols", [])
+    
+    try:
+        current_user = await get_current_user(vnc_relay.token_from_subprotocols(subprotocols))
+    except HTTPException:
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    db = SessionLocal()
+    try:
+        db_machine = db.query(VNCMachine).filter(VNCMachine.id == machine_id).first()
+    finally:
+        db.close()
+    
+    # Check permissions
+    if not db_machine or (not db_machine.is_shared and db_machine.owner_id != current_user.id):
+        await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+        return
+    
+    # Connect to the cached endpoint; if it stopped answering, re-resolve once
+    upstream = None
+    endpoint = await run_in_threadpool(resolver.resolve, db_machine.url)
+    for attempt in range(2):
+        if endpoint:
+            target = await run_in_threadpool(allowed_target, endpoint)
+            if target is None:
+                logger.warning(f"Relay target {endpoint} is not allowed")
+                await websocket.close(code=status.WS_1008_POLICY_VIOLATION)
+                return
+            try:
+                upstream = await vnc_relay.connect_upstream(endpoint, target)
+                break
+            except Exception as e:
+                logger.warning(f"Relay cannot connect to {endpoint}: {e}")
+        if attempt == 0:
+            previous = endpoint
+            endpoint = await run_in_threadpool(resolver.resolve, db_machine.url, True)
+            if endpoint == previous:
+                break
+    if upstream is None:
+        await websocket.close(code=status.WS_1011_INTERNAL_ERROR)
+        return
+    
+    try:
+        await websocket.accept(subprotocol="binary" if "binary" in subprotocols else None)
+        
+        stats, user_bucket = vnc_relay.registry.open({
+            "machine_id": db_machine.id,
+            "user_id": current_user.id,
+            "username": current_user.username,
+            "upstream": endpoint,
+            "deflate": await vnc_relay.negotiated_deflate(websocket),
+        })
+        try:
+            await vnc_relay.relay_session(websocket, upstream, stats, user_bucket)
+        finally:
+            vnc_relay.registry.close(stats)
+            summary = stats.as_dict()
+            logger.info(
+                f"Relay session {stats.session_id} closed: machine={stats.machine_id} user={stats.username} "
+                f"ratio={summary['compression_ratio']} queue_delay_max={summary['queue_delay_max_ms']:.0f}ms "
+                f"coalesced={stats.update_requests_coalesced}/{stats.update_requests}"
+            )
+    finally:
+        # Also covers accept() failing, e.g. when the browser has already gone
+        await upstream.close()
+
+
+@app.get("/api/relay/sessions", response_model=List[RelaySessionStats])
+def get_relay_sessions(current_user: User = Depends(get_current_admin_user)):
+    """Live statistics of relayed VNC sessions"""
+    return [stats.as_dict() for stats in list(vnc_relay.registry.sessions.values())]
 
 
 @app.get("/api/auth/admin-info")
@@ -0,0 +1,314 @@
+"""
+Benchmark ścieżki VNC: otwiera wiele równoległych połączeń RFB i mierzy
+klatki/s, bajty/s, czas nawiązania połączenia oraz pamięć na połączenie.
+
+Cel może być serwerem RFB (host:port) albo dowolnym endpointem WebSocket
+(ws://... / wss://...), np. websockify lub ścieżką WebSocket backendu.
+
+Uruchom:
+    python fake_rfb_server.py --port 5900 --websocket-port 6080 &
+    python rfb_benchmark.py 127.0.0.1:5900 --connections 50 --duration 10
+    python rfb_benchmark.py ws://127.0.0.1:6080/websockify --connections 50
+"""
+import argparse
+import asyncio
+import json
+import struct
+import sys
+import time
+from typing import List, Optional
+
+import rfb_protocol as rfb
+
+
+class CountingStream:
+    """Wraps a TCP/WebSocket stream and counts the RFB bytes read into ``result``."""
+
+    def __init__(self, stream, result: "ClientResult"):
+        self.stream = stream
+        self.result = result
+
+    async def readexactly(self, n: int) -> bytes:
+        data = await self.stream.readexactly(n)
+        self.result.bytes_read += n
+        return data
+
+    async def write(self, data: bytes):
+        await self.stream.write(data)
+
+    async def close(self):
+        await self.stream.close()
+
+
+class ClientResult:
+    def __init__(self):
+        self.connect_latency: Optional[float] = None
+        self.frames = 0
+        self.bytes_read = 0
+        self.error: Optional[str] = None
+
+
+async def open_stream(target: str, deflate: bool, timeout: float, token: Optional[str] = None):
+    if target.startswith("ws://") or target.startswith("wss://"):
+        import websockets
+        subprotocols = ["binary"]
+        if token:
+            # Backend relay authentication, see vnc_relay.TOKEN_SUBPROTOCOL_PREFIX
+            subprotocols.append(f"auth.{token}")
+        websocket = await websockets.connect(
+            target,
+            subprotocols=subprotocols,
+            compression="deflate" if deflate else None,
+            max_size=None,
+            open_timeout=timeout,
+        )
+        return rfb.WebSocketStream(websocket)
+
+    host, separator, port = target.rpartition(":")
+    if not separator:
+        host, port = target, ""
+    reader, writer = await asyncio.wait_for(
+        asyncio.open_connection(host or "127.0.0.1", int(port or 5900)), timeout
+    )
+    return rfb.TCPStream(reader, writer)
+
+
+async def handshake(stream) -> tuple:
+    """Negotiate RFB 3.8 with security type None and return the screen size."""
+    version = await stream.readexactly(12)
+    if not version.startswith(b"RFB "):
+        raise ConnectionError(f"Not an RFB server: {version!r}")
+    await stream.write(rfb.PROTOCOL_VERSION)
+
+    count = (await stream.readexactly(1))[0]
+    if count == 0:
+        length, = struct.unpack(">I", await stream.readexactly(4))
+        reason = await stream.readexactly(length)
+        raise ConnectionError(f"Server refused connection: {reason.decode('utf-8', 'replace')}")
+    types = await stream.readexactly(count)
+    if rfb.SECURITY_NONE not in types:
+        raise ConnectionError(f"Security type None not offered (got {list(types)})")
+    await stream.write(bytes([rfb.SECURITY_NONE]))
+
+    result, = struct.unpack(">I", await stream.readexactly(4))
+    if result != 0:
+        raise ConnectionError("Security handshake failed")
+    await stream.write(b"\x01")  # ClientInit: shared session
+
+    width, height = struct.unpack(">HH", await stream.readexactly(4))
+    await stream.readexactly(16)  # pixel format, always 32 bpp here
+    name_length, = struct.unpack(">I", await stream.readexactly(4))
+    await stream.readexactly(name_length)
+    return width, height
+
+
+async def read_rect(stream, width: int, height: int, encoding: int):
+    if encoding == rfb.ENCODING_RAW:
+        await stream.readexactly(width * height * rfb.BYTES_PER_PIXEL)
+    elif encoding == rfb.ENCODING_COPYRECT:
+        await stream.readexactly(4)
+    elif encoding == rfb.ENCODING_RRE:
+        subrects, = struct.unpack(">I", await stream.readexactly(4))
+        await stream.readexactly(rfb.BYTES_PER_PIXEL + subrects * (rfb.BYTES_PER_PIXEL + 8))
+    elif encoding == rfb.ENCODING_ZLIB:
+        length, = struct.unpack(">I", await stream.readexactly(4))
+        await stream.readexactly(length)
+    elif encoding < 0:
+        pass  # pseudo-encodings carry no payload for the ones we advertise
+    else:
+        raise ConnectionError(f"Unexpected encoding {encoding}")
+
+
+async def read_server_message(stream) -> bool:
+    """Read one server message; returns True if it was a framebuffer update."""
+    message_type = (await stream.readexactly(1))[0]
+    if message_type == rfb.SERVER_FRAMEBUFFER_UPDATE:
+        _, rect_count = struct.unpack(">BH", await stream.readexactly(3))
+        for _ in range(rect_count):
+            _, _, w, h, encoding = struct.unpack(">HHHHi", await stream.readexactly(12))
+            await read_rect(stream, w, h, encoding)
+        return True
+    if message_type == rfb.SERVER_SET_COLOUR_MAP_ENTRIES:
+        _, _, colours = struct.unpack(">BHH", await stream.readexactly(5))
+        await stream.readexactly(colours * 6)
+    elif message_type == rfb.SERVER_CUT_TEXT:
+        _, length = struct.unpack(">3sI", await stream.readexactly(7))
+        await stream.readexactly(length)
+    elif message_type != rfb.SERVER_BELL:
+        raise ConnectionError(f"Unexpected server message type {message_type}")
+    return False
+
+
+async def run_client(args, result: ClientResult, ready: asyncio.Event, gate: asyncio.Semaphore):
+    """Connect, receive the initial full frame, set ``ready`` and keep requesting updates."""
+    stream = None
+
+    async def first_frame():
+        while not await read_server_message(stream):
+            pass
+        result.frames += 1
+
+    try:
+        async with gate:
+            started = time.perf_counter()
+            stream = CountingStream(await open_stream(args.target, args.deflate, args.timeout, args.token), result)
+            width, height = await asyncio.wait_for(handshake(stream), args.timeout)
+            result.connect_latency = time.perf_counter() - started
+
+        encodings = [rfb.ENCODINGS[args.encoding]]
+        if args.encoding != "raw":
+            encodings.append(rfb.ENCODING_RAW)
+        await stream.write(rfb.pack_set_encodings(encodings))
+        await stream.write(rfb.pack_update_request(False, 0, 0, width, height))
+        await asyncio.wait_for(first_frame(), args.timeout)
+        ready.set()
+
+        while True:
+            await stream.write(rfb.pack_update_request(True, 0, 0, width, height))
+            while not await read_server_message(stream):
+                pass
+            result.frames += 1
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        result.error = f"{type(e).__name__}: {e}"
+    finally:
+        ready.set()
+        if stream:
+            await stream.close()
+
+
+def read_rss(pid="self") -> Optional[int]:
+    """Resident set size in bytes, read from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def percentile(values: List[float], fraction: float) -> Optional[float]:
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+async def run_benchmark(args) -> dict:
+    results = [ClientResult() for _ in range(args.connections)]
+    events = [asyncio.Event() for _ in results]
+    gate = asyncio.Semaphore(args.connect_concurrency)
+
+    rss_before = read_rss()
+    server_rss_before = read_rss(args.server_pid) if args.server_pid else None
+
+    started = time.perf_counter()
+    tasks = [
+        asyncio.ensure_future(run_client(args, result, event, gate))
+        for result, event in zip(results, events)
+    ]
+    await asyncio.gather(*(event.wait() for event in events))
+    connected = [r for r in results if r.connect_latency is not None]
+
+    rss_after = read_rss()
+    server_rss_after = read_rss(args.server_pid) if args.server_pid else None
+
+    # Only traffic inside the measurement window counts: every client has
+    # received its initial full frame by now, and neither those nor what
+    # arrived while other clients were still connecting inflate the rates
+    frames_before = sum(r.frames for r in results)
+    bytes_before = sum(r.bytes_read for r in results)
+    measure_from = time.perf_counter()
+    await asyncio.sleep(args.duration)
+    elapsed = time.perf_counter() - measure_from
+    frames = sum(r.frames for r in results) - frames_before
+    total_bytes = sum(r.bytes_read for r in results) - bytes_before
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    latencies = [r.connect_latency * 1000 for r in connected]
+
+    def per_connection(before, after):
+        if before is None or after is None or not connected:
+            return None
+        return (after - before) / len(connected)
+
+    return {
+        "target": args.target,
+        "connections": args.connections,
+        "connected": len(connected),
+        "failed": sum(1 for r in results if r.error),
+        "errors": sorted({r.error for r in results if r.error})[:10],
+        "ramp_seconds": measure_from - started,
+        "duration_seconds": elapsed,
+        "frames": frames,
+        "frames_per_second": frames / elapsed,
+        "frames_per_second_per_connection": frames / elapsed / len(connected) if connected else 0.0,
+        "bytes": total_bytes,
+        "bytes_per_second": total_bytes / elapsed,
+        "connect_ms_p50": percentile(latencies, 0.5),
+        "connect_ms_p95": percentile(latencies, 0.95),
+        "connect_ms_max": max(latencies) if latencies else None,
+        "client_rss_per_connection": per_connection(rss_before, rss_after),
+        "server_rss_per_connection": per_connection(server_rss_before, server_rss_after),
+    }
+
+
+def format_report(report: dict) -> str:
+    def ms(value):
+        return "-" if value is None else f"{value:.1f} ms"
+
+    def mem(value):
+        return "-" if value is None else f"{value / 1024:.1f} KiB"
+
+    lines = [
+        f"Cel:                  {report['target']}",
+        f"Połączenia:           {report['connected']}/{report['connections']} (błędy: {report['failed']})",
+        f"Czas pomiaru:         {report['duration_seconds']:.2f} s",
+        f"Klatki/s:             {report['frames_per_second']:.1f} "
+        f"({report['frames_per_second_per_connection']:.2f} na połączenie)",
+        f"Bajty/s:              {report['bytes_per_second'] / 1024 / 1024:.2f} MiB/s",
+        f"Nawiązanie p50/p95/max: {ms(report['connect_ms_p50'])} / "
+        f"{ms(report['connect_ms_p95'])} / {ms(report['connect_ms_max'])}",
+        f"Pamięć klienta/poł.:  {mem(report['client_rss_per_connection'])}",
+        f"Pamięć serwera/poł.:  {mem(report['server_rss_per_connection'])}",
+    ]
+    for error in report["errors"]:
+        lines.append(f"  błąd: {error}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark przepustowości ścieżki VNC")
+    parser.add_argument("target", help="host:port serwera RFB albo URL ws:// / wss://")
+    parser.add_argument("--connections", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=10.0, help="czas pomiaru w sekundach")
+    parser.add_argument("--encoding", choices=["raw", "rre", "zlib"], default="raw")
+    parser.add_argument("--deflate", action="store_true", help="negocjuj permessage-deflate (tylko WebSocket)")
+    parser.add_argument("--token", help="JWT dla ścieżki /api/machines/{id}/relay backendu")
+    parser.add_argument("--timeout", type=float, default=10.0, help="limit czasu nawiązania połączenia")
+    parser.add_argument("--connect-concurrency", type=int, default=50, help="maks. równoległych nawiązań")
+    parser.add_argument("--server-pid", help="PID procesu (np. backendu), którego pamięć mierzyć")
+    parser.add_argument("--json", action="store_true", help="wypisz raport jako JSON")
+    parser.add_argument("--min-fps", type=float, default=0.0, help="błąd, jeśli klatki/s poniżej progu")
+    parser.add_argument("--max-connect-ms", type=float, default=0.0, help="błąd, jeśli p95 nawiązania powyżej progu")
+    args = parser.parse_args()
+
+    report = asyncio.run(run_benchmark(args))
+    print(json.dumps(report, indent=2) if args.json else format_report(report))
+
+    failed = report["failed"] > 0
+    if args.min_fps and report["frames_per_second"] < args.min_fps:
+        failed = True
+    if args.max_connect_ms and (report["connect_ms_p95"] or float("inf")) > args.max_connect_ms:
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
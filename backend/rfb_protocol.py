@@ -0,0 +1,129 @@
+"""
+Wspólne elementy protokołu RFB (VNC) używane przez narzędzia testowe backendu.
+"""
+import asyncio
+import struct
+
+PROTOCOL_VERSION = b"RFB 003.008\n"
+
+# Security types
+SECURITY_INVALID = 0
+SECURITY_NONE = 1
+SECURITY_VNC_AUTH = 2
+
+# Client -> server message types
+CLIENT_SET_PIXEL_FORMAT = 0
+CLIENT_SET_ENCODINGS = 2
+CLIENT_FRAMEBUFFER_UPDATE_REQUEST = 3
+CLIENT_KEY_EVENT = 4
+CLIENT_POINTER_EVENT = 5
+CLIENT_CUT_TEXT = 6
+
+# Server -> client message types
+SERVER_FRAMEBUFFER_UPDATE = 0
+SERVER_SET_COLOUR_MAP_ENTRIES = 1
+SERVER_BELL = 2
+SERVER_CUT_TEXT = 3
+
+# Encodings
+ENCODING_RAW = 0
+ENCODING_COPYRECT = 1
+ENCODING_RRE = 2
+ENCODING_ZLIB = 6
+
+ENCODINGS = {
+    "raw": ENCODING_RAW,
+    "copyrect": ENCODING_COPYRECT,
+    "rre": ENCODING_RRE,
+    "zlib": ENCODING_ZLIB,
+}
+
+# Fixed sizes of client messages that carry no variable-length payload
+CLIENT_MESSAGE_SIZES = {
+    CLIENT_SET_PIXEL_FORMAT: 20,
+    CLIENT_FRAMEBUFFER_UPDATE_REQUEST: 10,
+    CLIENT_KEY_EVENT: 8,
+    CLIENT_POINTER_EVENT: 6,
+}
+
+BYTES_PER_PIXEL = 4
+
+
+def pack_pixel_format() -> bytes:
+    """32 bpp, depth 24, little-endian true colour (the format noVNC asks for)."""
+    return struct.pack(
+        ">BBBBHHHBBBxxx",
+        32, 24, 0, 1,
+        255, 255, 255,
+        16, 8, 0,
+    )
+
+
+def pack_server_init(width: int, height: int, name: str) -> bytes:
+    name_bytes = name.encode("utf-8")
+    return struct.pack(">HH", width, height) + pack_pixel_format() + \
+        struct.pack(">I", len(name_bytes)) + name_bytes
+
+
+def pack_set_encodings(encodings) -> bytes:
+    return struct.pack(">BxH", CLIENT_SET_ENCODINGS, len(encodings)) + \
+        b"".join(struct.pack(">i", e) for e in encodings)
+
+
+def pack_update_request(incremental: bool, x: int, y: int, width: int, height: int) -> bytes:
+    return struct.pack(
+        ">BBHHHH", CLIENT_FRAMEBUFFER_UPDATE_REQUEST, 1 if incremental else 0,
+        x, y, width, height
+    )
+
+
+class WebSocketStream:
+    """
+    Byte-stream view of a WebSocket connection.
+
+    RFB is a stream protocol, while websockify (and the ``websockets``
+    library) hand us whole binary messages, so reads are served from an
+    internal buffer refilled one message at a time.
+    """
+
+    def __init__(self, websocket):
+        self.websocket = websocket
+        self._buffer = bytearray()
+
+    async def readexactly(self, n: int) -> bytes:
+        while len(self._buffer) < n:
+            message = await self.websocket.recv()
+            if isinstance(message, str):
+                message = message.encode("latin-1")
+            self._buffer += message
+        data = bytes(self._buffer[:n])
+        del self._buffer[:n]
+        return data
+
+    async def write(self, data: bytes):
+        await self.websocket.send(data)
+
+    async def close(self):
+        await self.websocket.close()
+
+
+class TCPStream:
+    """Same interface as :class:`WebSocketStream` on top of asyncio streams."""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    async def readexactly(self, n: int) -> bytes:
+        return await self.reader.readexactly(n)
+
+    async def write(self, data: bytes):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (ConnectionError, OSError):
+            pass
@@ -62,11 +62,37 @@ class VNCMachineResponse(VNCMachineBase):
     is_shared: bool
     created_at: datetime
     updated_at: Optional[datetime] = None
+    # WebSocket endpoint that answered a probe; None if none did (see ws_resolver)
+    ws_url: Optional[str] = None
 
     class Config:
         from_attributes = True
 
 
+class RelaySessionStats(BaseModel):
+    session_id: int
+    machine_id: int
+    user_id: int
+    username: str
+    upstream: str
+    deflate: bool
+    duration_seconds: float
+    bytes_to_client: int
+    # Estimated bytes on the wire after permessage-deflate; None without deflate
+    compressed_bytes_to_client: Optional[int] = None
+    compression_ratio: Optional[float] = None
+    bytes_to_server: int
+    client_bytes_per_second: float
+    queue_delay_avg_ms: float
+    queue_delay_max_ms: float
+    throttled_seconds: float
+    update_requests: int
+    # Held back while the client was behind / merged into an already held one
+    update_requests_deferred: int
+    update_requests_coalesced: int
+    backlog_bytes: int
+
+
 class Token(BaseModel):
     access_token: str
     token_type: str
@@ -0,0 +1,78 @@
+import asyncio
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+# Backend modules import each other as top-level modules (``import rfb_protocol``)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fake_rfb_server import FakeRFBServer  # noqa: E402
+
+
+def _polls(condition, timeout: float):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "condition not met in time"
+        yield
+
+
+def wait_until(condition, timeout: float = 5.0):
+    """Poll ``condition`` until it holds; fails the test after ``timeout`` seconds."""
+    for _ in _polls(condition, timeout):
+        time.sleep(0.01)
+
+
+async def async_wait_until(condition, timeout: float = 5.0):
+    """:func:`wait_until` for code running on an event loop."""
+    for _ in _polls(condition, timeout):
+        await asyncio.sleep(0.01)
+
+
+class FakeServerThread:
+    """
+    Runs fake RFB servers on an event loop of their own, so tests can reach
+    them from blocking code and from their own ``asyncio.run`` alike.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.servers = []
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def start(self, transport: str, **server_args) -> int:
+        """Start a ``FakeRFBServer`` on an ephemeral port and return the port."""
+        server = FakeRFBServer(**server_args)
+        start = server.start_websocket if transport == "websocket" else server.start_tcp
+        listener = asyncio.run_coroutine_threadsafe(start("127.0.0.1", 0), self.loop).result()
+        self.servers.append(server)
+        return next(iter(listener.sockets)).getsockname()[1]
+
+    def stop(self):
+        for server in self.servers:
+            asyncio.run_coroutine_threadsafe(server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.close()
+
+
+@pytest.fixture
+def fake_server_thread():
+    servers = FakeServerThread()
+    yield servers
+    servers.stop()
+
+
+@pytest.fixture
+def fake_websockify(fake_server_thread):
+    """Factory: ``fake_websockify(**server_args)`` starts a fake websockify and returns its port."""
+    return lambda **server_args: fake_server_thread.start("websocket", **server_args)
+
+
+@pytest.fixture
+def fake_rfb_tcp(fake_server_thread):
+    """Factory: ``fake_rfb_tcp(**server_args)`` starts a fake VNC server and returns its port."""
+    return lambda **server_args: fake_server_thread.start("tcp", **server_args)
@@ -0,0 +1,36 @@
+import argparse
+import asyncio
+
+import pytest
+
+from rfb_benchmark import run_benchmark
+
+WIDTH, HEIGHT = 512, 256
+FULL_FRAME_BYTES = WIDTH * HEIGHT * 4
+# change=0.01 repaints one 64x64 tile: update header + rectangle header + raw pixels
+INCREMENTAL_FRAME_BYTES = 4 + 12 + 64 * 64 * 4
+
+
+def benchmark_args(target, **overrides):
+    args = dict(
+        target=target, connections=3, duration=0.5, encoding="raw", deflate=False, token=None,
+        timeout=5.0, connect_concurrency=2, server_pid=None,
+    )
+    args.update(overrides)
+    return argparse.Namespace(**args)
+
+
+@pytest.mark.parametrize("transport", ["tcp", "websocket"])
+def test_run_benchmark_measures_only_incremental_updates(transport, fake_rfb_tcp, fake_websockify):
+    start = fake_websockify if transport == "websocket" else fake_rfb_tcp
+    port = start(width=WIDTH, height=HEIGHT, fps=10, change=0.01)
+    target = f"ws://127.0.0.1:{port}/websockify" if transport == "websocket" else f"127.0.0.1:{port}"
+
+    report = asyncio.run(run_benchmark(benchmark_args(target)))
+
+    assert report["connected"] == report["connections"] == 3
+    assert report["failed"] == 0, report["errors"]
+    assert report["frames"] > 0
+    # The initial full frames arrive during the ramp and must not be counted
+    assert report["bytes"] <= (report["frames"] + report["connections"]) * INCREMENTAL_FRAME_BYTES
+    assert report["bytes"] < FULL_FRAME_BYTES
@@ -0,0 +1,256 @@
+import asyncio
+import struct
+import time
+import zlib
+
+import pytest
+
+import rfb_protocol as rfb
+import vnc_relay
+from conftest import async_wait_until
+from schemas import RelaySessionStats
+from vnc_relay import (
+    ClientMessageParser, DeflateEstimator, RelayRegistry, RelayStats, TokenBucket,
+    merge_update_requests, relay_session,
+)
+
+HANDSHAKE = rfb.PROTOCOL_VERSION + bytes([rfb.SECURITY_NONE]) + b"\x01"
+
+
+def feed_all(parser, data, chunk=None):
+    chunk = chunk or len(data)
+    items = []
+    for i in range(0, len(data), chunk):
+        items.extend(parser.feed(data[i:i + chunk]))
+    return items
+
+
+def joined(items):
+    return b"".join(item for kind, item in items if kind == "data")
+
+
+def client_messages():
+    return [
+        rfb.pack_set_encodings([rfb.ENCODING_ZLIB, rfb.ENCODING_RAW, -223]),
+        struct.pack(">BxxxI", rfb.CLIENT_CUT_TEXT, 5) + b"hello",
+        # Extended clipboard: negative length
+        struct.pack(">Bxxxi", rfb.CLIENT_CUT_TEXT, -6) + b"\x00" * 6,
+        struct.pack(">BxxxIB", vnc_relay.CLIENT_FENCE, 0, 3) + b"abc",
+        struct.pack(">BxHHBx", vnc_relay.SET_DESKTOP_SIZE, 800, 600, 2) + b"\x01" * 32,
+        struct.pack(">BBHII", vnc_relay.QEMU_CLIENT_MESSAGE, vnc_relay.QEMU_EXTENDED_KEY_EVENT, 1, 0x61, 30),
+        struct.pack(">BBHHHH", 150, 1, 0, 0, 800, 600),
+        struct.pack(">BxBB", 250, 1, 2),
+        struct.pack(">BBHH", rfb.CLIENT_POINTER_EVENT, 1, 10, 20),
+        struct.pack(">BBxxI", rfb.CLIENT_KEY_EVENT, 1, 0x61),
+        rfb.pack_update_request(True, 0, 0, 800, 600),
+    ]
+
+
+@pytest.mark.parametrize("chunk", [None, 1, 3, 7])
+def test_parser_splits_messages_across_chunk_boundaries(chunk):
+    messages = client_messages()
+    stream = HANDSHAKE + b"".join(messages)
+    items = feed_all(ClientMessageParser(), stream, chunk)
+
+    data = [item for kind, item in items if kind == "data"]
+    requests = [item for kind, item in items if kind == "update_request"]
+    # Handshake is split into its three parts, then one item per message
+    assert data == [rfb.PROTOCOL_VERSION, b"\x01", b"\x01"] + messages[:-1]
+    assert requests == [(1, 0, 0, 800, 600)]
+
+
+def test_parser_follows_vnc_auth_handshake():
+    stream = rfb.PROTOCOL_VERSION + bytes([rfb.SECURITY_VNC_AUTH]) + b"\x03" * 16 + b"\x01" + \
+        rfb.pack_update_request(False, 1, 2, 3, 4)
+    items = feed_all(ClientMessageParser(), stream, 5)
+    assert items[-1] == ("update_request", (0, 1, 2, 3, 4))
+    assert joined(items) == stream[:-10]
+
+
+@pytest.mark.parametrize("stream", [
+    b"RFB 003.003\n" + rfb.pack_update_request(True, 0, 0, 1, 1),
+    rfb.PROTOCOL_VERSION + bytes([19]) + rfb.pack_update_request(True, 0, 0, 1, 1),
+    HANDSHAKE + b"\x99unknown" + rfb.pack_update_request(True, 0, 0, 1, 1),
+    HANDSHAKE + struct.pack(">BB", vnc_relay.QEMU_CLIENT_MESSAGE, 1) + rfb.pack_update_request(True, 0, 0, 1, 1),
+])
+def test_parser_falls_back_to_passthrough(stream):
+    parser = ClientMessageParser()
+    items = feed_all(parser, stream, 4)
+    assert parser.passthrough
+    assert all(kind == "data" for kind, _ in items)
+    assert joined(items) == stream
+    assert parser.feed(b"more") == [("data", b"more")]
+
+
+def test_merge_update_requests():
+    # Bounding box of both regions
+    assert merge_update_requests((1, 10, 10, 10, 10), (1, 0, 15, 5, 20)) == (1, 0, 10, 20, 25)
+    # A full refresh wins over an incremental request, in either order
+    assert merge_update_requests((1, 0, 0, 5, 5), (0, 0, 0, 5, 5))[0] == 0
+    assert merge_update_requests((0, 0, 0, 5, 5), (1, 0, 0, 5, 5))[0] == 0
+
+
+def test_token_bucket_debt_and_refill():
+    async def scenario():
+        bucket = TokenBucket(rate=1000, burst=100)
+        assert await bucket.consume(100) == 0.0
+        # Overdraw: the frame goes out whole and the caller pays back the debt
+        started = time.monotonic()
+        waited = await bucket.consume(200)
+        assert waited == pytest.approx(0.2, abs=0.02)
+        assert time.monotonic() - started >= 0.19
+
+        await asyncio.sleep(0.1)
+        bucket._refill()
+        assert bucket.tokens == pytest.approx(100, abs=10)  # refilled, capped at burst
+        await asyncio.sleep(0.2)
+        bucket._refill()
+        assert bucket.tokens == 100
+
+    asyncio.run(scenario())
+
+
+def test_unlimited_bucket_never_waits():
+    assert asyncio.run(TokenBucket(rate=0).consume(10 ** 9)) == 0.0
+
+
+def test_registry_shares_user_bucket_between_sessions(monkeypatch):
+    monkeypatch.setattr(vnc_relay, "RELAY_USER_RATE", 1000)
+    registry = RelayRegistry()
+
+    def open_session(user_id):
+        return registry.open({
+            "machine_id": 1, "user_id": user_id, "username": "u", "upstream": "ws://x", "deflate": False,
+        })
+
+    first, bucket_a = open_session(1)
+    second, bucket_b = open_session(1)
+    other, bucket_c = open_session(2)
+    assert bucket_a is bucket_b
+    assert bucket_c is not bucket_a
+    assert set(registry.sessions) == {first.session_id, second.session_id, other.session_id}
+
+    registry.close(first)
+    third, bucket_d = open_session(1)
+    assert bucket_d is bucket_a  # still shared while a session of the user is open
+    registry.close(second)
+    registry.close(third)
+    _, bucket_e = open_session(1)
+    assert bucket_e is not bucket_a
+
+
+def test_deflate_estimator_exact_when_sampling_every_message():
+    data = [bytes(range(256)) * 40, b"\x00" * 5000, bytes(range(256)) * 40]
+    compressor = zlib.compressobj(wbits=-15)
+    expected = [len(compressor.compress(d) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4 for d in data]
+
+    async def scenario():
+        estimator = DeflateEstimator(sample=1)
+        return [await estimator.compressed_size(d) for d in data]
+
+    assert asyncio.run(scenario()) == expected
+
+
+def test_deflate_estimator_applies_sampled_ratio():
+    async def scenario():
+        estimator = DeflateEstimator(sample=4)
+        first = await estimator.compressed_size(b"\x00" * 10000)
+        second = await estimator.compressed_size(b"\x00" * 20000)
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert second == round(20000 * first / 10000)
+
+
+@pytest.mark.parametrize("deflate, compressed, ratio", [(True, 250, 4.0), (False, None, None)])
+def test_stats_report_compression_only_with_deflate(deflate, compressed, ratio):
+    stats = RelayStats(1, machine_id=1, user_id=1, username="t", upstream="fake", deflate=deflate)
+    stats.bytes_to_client = 1000
+    stats.compressed_bytes_to_client = 250 if deflate else 1000
+    summary = stats.as_dict()
+    assert summary["compressed_bytes_to_client"] == compressed
+    assert summary["compression_ratio"] == ratio
+    RelaySessionStats(**summary)
+
+
+def test_negotiated_deflate_warns_once_without_uvicorn_protocol(monkeypatch, caplog):
+    class Receiver:
+        async def receive(self):
+            pass
+
+    class Protocol(Receiver):
+        extensions = [type("Extension", (), {"name": "permessage-deflate"})()]
+
+    class Socket:
+        def __init__(self, receiver):
+            self._receive = receiver.receive
+
+    monkeypatch.setattr(vnc_relay, "_unknown_server_warned", False)
+    assert asyncio.run(vnc_relay.negotiated_deflate(Socket(Protocol()))) is True
+    assert not caplog.records
+
+    for _ in range(2):
+        assert asyncio.run(vnc_relay.negotiated_deflate(Socket(Receiver()))) is False
+    assert [r.levelname for r in caplog.records] == ["WARNING"]
+
+
+class SlowBrowser:
+    """Stands in for the Starlette WebSocket of a browser on a slow link."""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.incoming = asyncio.Queue()
+        self.received = bytearray()
+
+    async def receive(self):
+        return await self.incoming.get()
+
+    async def send_bytes(self, data):
+        if len(data) > 1000:
+            await asyncio.sleep(self.delay)
+        self.received += data
+
+    def push(self, data):
+        self.incoming.put_nowait({"type": "websocket.receive", "bytes": data})
+
+    def disconnect(self):
+        self.incoming.put_nowait({"type": "websocket.disconnect", "code": 1000})
+
+
+def test_relay_coalesces_update_requests_while_client_is_behind(monkeypatch, fake_websockify):
+    monkeypatch.setattr(vnc_relay, "RELAY_BACKLOG_LIMIT", 1000)
+    monkeypatch.setattr(vnc_relay, "RELAY_SESSION_RATE", 0)
+    port = fake_websockify(width=320, height=240, fps=0, change=0.1)
+
+    async def scenario():
+        upstream = await vnc_relay.connect_upstream(f"ws://127.0.0.1:{port}/websockify", ("127.0.0.1", port))
+        stats = RelayStats(1, machine_id=1, user_id=1, username="t", upstream="fake", deflate=False)
+        browser = SlowBrowser(delay=0.5)
+        relay = asyncio.ensure_future(relay_session(browser, upstream, stats, None))
+        try:
+            browser.push(HANDSHAKE + rfb.pack_set_encodings([rfb.ENCODING_RAW]))
+            browser.push(rfb.pack_update_request(False, 0, 0, 320, 240))
+            # The full frame (300 KiB raw) sits in the queue behind the slow link
+            await async_wait_until(lambda: stats.backlog_bytes >= 1000)
+            sent_before = stats.bytes_to_server
+
+            browser.push(rfb.pack_update_request(True, 0, 0, 160, 120))
+            browser.push(rfb.pack_update_request(True, 160, 120, 160, 120))
+            browser.push(rfb.pack_update_request(True, 0, 0, 10, 10))
+            await async_wait_until(lambda: stats.update_requests == 4)
+            assert stats.update_requests_deferred == 3
+            assert stats.update_requests_coalesced == 2
+            assert stats.bytes_to_server == sent_before  # nothing forwarded while behind
+
+            # Once the frame is delivered, exactly one merged request goes upstream
+            await async_wait_until(lambda: stats.bytes_to_server == sent_before + 10)
+            await async_wait_until(lambda: stats.messages_to_client >= 6)
+            assert stats.queue_delay_max >= 0.4
+        finally:
+            browser.disconnect()
+            await asyncio.wait_for(relay, 5)
+            await upstream.close()
+        return stats
+
+    stats = asyncio.run(scenario())
+    assert stats.update_requests_coalesced == 2
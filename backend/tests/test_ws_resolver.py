@@ -0,0 +1,204 @@
+import threading
+import time
+
+import pytest
+
+import ws_resolver
+from conftest import wait_until
+from ws_resolver import WebSocketEndpointResolver, allowed_target, candidate_endpoints, probe_endpoint
+
+
+class FakeProbe:
+    """Answers for the endpoints in ``working``; records every call."""
+
+    def __init__(self, working=(), delay=0.0, error=None):
+        self.working = set(working)
+        self.delay = delay
+        self.error = error
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def __call__(self, endpoint, timeout):
+        with self._lock:
+            self.calls.append(endpoint)
+        if self.delay:
+            time.sleep(self.delay)
+        if self.error:
+            raise self.error
+        return endpoint in self.working
+
+
+@pytest.mark.parametrize("url, expected_first, frontend_guess", [
+    # The first entry of each case is what buildWebSocketUrl in VNCViewer.tsx would use
+    ("ws://10.0.0.5:6080/websockify", "ws://10.0.0.5:6080/websockify", "ws://10.0.0.5:6080/websockify"),
+    ("http://board:6080/vnc.html", "ws://board:6080/websockify", "ws://board:6080/websockify"),
+    ("https://board/vnc.html", "wss://board:443/websockify", "wss://board:443/websockify"),
+    ("http://proxy:8080/vnc.html?host=board&port=6081", "ws://board:6081/websockify", "ws://board:6081/"),
+    ("board:6080", "ws://board:6080/websockify", "ws://board:6080/websockify"),
+    ("board", "ws://board:5900", "ws://board:5900"),
+    ("http://[fd00::5]:6080/vnc.html", "ws://[fd00::5]:6080/websockify", "ws://[fd00::5]:6080/websockify"),
+])
+def test_candidate_endpoints_cover_frontend_guess(url, expected_first, frontend_guess):
+    candidates = candidate_endpoints(url)
+    assert candidates[0] == expected_first
+    assert frontend_guess in candidates
+
+
+def test_candidate_endpoints_prefer_path_param_and_novnc_directory():
+    assert candidate_endpoints("http://h:6080/noVNC/vnc.html?path=custom/ws") == [
+        "ws://h:6080/custom/ws",
+        "ws://h:6080/noVNC/websockify",
+        "ws://h:6080/websockify",
+        "ws://h:6080/",
+    ]
+    assert candidate_endpoints("ws://h:6080") == ["ws://h:6080", "ws://h:6080/websockify"]
+
+
+def test_candidate_endpoints_bracket_ipv6_hosts():
+    assert candidate_endpoints("http://proxy/vnc.html?host=fd00::5&port=6081") == [
+        "ws://[fd00::5]:6081/websockify",
+        "ws://[fd00::5]:6081/",
+    ]
+
+
+@pytest.mark.parametrize("url", [
+    "myboard:abc",
+    "http://host:99999/noVNC",
+    "http://h/vnc.html?host=a&port=b",
+    "ws://h:abc/websockify",
+])
+def test_malformed_urls_yield_no_candidates_and_resolve_to_none(url):
+    assert candidate_endpoints(url) == []
+    resolver = WebSocketEndpointResolver(probe=FakeProbe())
+    assert resolver.resolve(url) is None
+
+
+def test_probe_endpoint_rejects_bad_port_without_raising():
+    assert probe_endpoint("ws://host:99999/") is False
+    assert probe_endpoint("ws://host:abc/") is False
+
+
+def test_resolve_picks_most_likely_working_candidate():
+    probe = FakeProbe(working={"ws://h:6080/websockify", "ws://h:6080/"})
+    resolver = WebSocketEndpointResolver(probe=probe)
+    assert resolver.resolve("http://h:6080/vnc.html") == "ws://h:6080/websockify"
+    assert resolver.cached("http://h:6080/vnc.html") == (True, "ws://h:6080/websockify")
+
+
+def test_fresh_entry_is_not_reprobed():
+    probe = FakeProbe(working={"ws://h:6080/websockify"})
+    resolver = WebSocketEndpointResolver(probe=probe)
+    resolver.resolve("h:6080")
+    calls = len(probe.calls)
+    assert resolver.resolve_many(["h:6080", "h:6080"]) == {"h:6080": "ws://h:6080/websockify"}
+    assert len(probe.calls) == calls
+
+
+def test_expired_entry_is_served_stale_and_reprobed_in_background():
+    probe = FakeProbe(working={"ws://h:6080/websockify"})
+    resolver = WebSocketEndpointResolver(ttl=0.05, probe=probe)
+    assert resolver.resolve("h:6080") == "ws://h:6080/websockify"
+
+    time.sleep(0.06)
+    assert resolver.cached("h:6080") == (False, None)
+    probe.working = {"ws://h:6080/"}
+    probe.delay = 0.2
+    started = time.monotonic()
+    # The stale value comes back without waiting for the slow probe
+    assert resolver.resolve("h:6080") == "ws://h:6080/websockify"
+    assert time.monotonic() - started < 0.1
+
+    wait_until(lambda: resolver.cached("h:6080") == (True, "ws://h:6080/"))
+
+
+def test_failure_is_cached_for_failure_ttl():
+    probe = FakeProbe()
+    resolver = WebSocketEndpointResolver(ttl=60, failure_ttl=0.05, probe=probe)
+    assert resolver.resolve("h:6080") is None
+    assert resolver.cached("h:6080") == (True, None)
+
+    time.sleep(0.06)
+    assert resolver.cached("h:6080") == (False, None)
+    probe.working = {"ws://h:6080/websockify"}
+    resolver.resolve("h:6080")
+    wait_until(lambda: resolver.cached("h:6080") == (True, "ws://h:6080/websockify"))
+
+
+def test_refresh_invalidates_and_resolves_again():
+    probe = FakeProbe(working={"ws://h:6080/websockify"})
+    resolver = WebSocketEndpointResolver(probe=probe, refresh_min_age=0)
+    assert resolver.resolve("h:6080") == "ws://h:6080/websockify"
+
+    probe.working = {"ws://h:6080/"}
+    assert resolver.resolve("h:6080") == "ws://h:6080/websockify"
+    assert resolver.resolve("h:6080", refresh=True) == "ws://h:6080/"
+
+    resolver.invalidate("h:6080")
+    assert resolver.cached("h:6080") == (False, None)
+
+
+def test_refresh_of_recent_entry_is_ignored():
+    probe = FakeProbe(working={"ws://h:6080/websockify"})
+    resolver = WebSocketEndpointResolver(probe=probe, refresh_min_age=0.1)
+    resolver.resolve("h:6080")
+    calls = len(probe.calls)
+
+    for _ in range(5):
+        assert resolver.resolve("h:6080", refresh=True) == "ws://h:6080/websockify"
+    assert len(probe.calls) == calls
+
+    time.sleep(0.11)
+    assert resolver.refresh("h:6080") is True
+    resolver.resolve("h:6080")
+    assert len(probe.calls) > calls
+
+
+def test_unfinished_probes_are_not_cached_as_failures():
+    # One worker and slow probes: the first resolve gives up before the pool drains
+    probe = FakeProbe(working={"ws://ok:6080/websockify"}, delay=0.1)
+    resolver = WebSocketEndpointResolver(timeout=0.01, workers=1, probe=probe)
+    urls = [f"silent{i}:6080" for i in range(6)] + ["ok:6080"]
+
+    result = resolver.resolve_many(urls)
+    assert result["ok:6080"] is None
+    assert resolver.cached("ok:6080") == (False, None)
+
+    wait_until(lambda: resolver.cached("ok:6080") == (True, "ws://ok:6080/websockify"), timeout=5)
+
+
+def test_probe_exception_counts_as_failed_probe():
+    resolver = WebSocketEndpointResolver(probe=FakeProbe(error=RuntimeError("boom")))
+    assert resolver.resolve("h:6080") is None
+
+
+@pytest.mark.parametrize("endpoint, networks, ports, expected", [
+    ("ws://10.1.2.3:6080/websockify", "", "6080", ("10.1.2.3", 6080)),
+    ("ws://10.1.2.3:22/", "", "80,443,5900-5999,6080-6099", None),
+    ("wss://10.1.2.3/", "", "80,443", ("10.1.2.3", 443)),
+    ("ws://10.1.2.3:5901/", "10.1.0.0/16", "5900-5999", ("10.1.2.3", 5901)),
+    ("ws://10.2.0.1:5901/", "10.1.0.0/16", "5900-5999", None),
+    ("ws://[fd00::5]:6080/", "fd00::/8", "", ("fd00::5", 6080)),
+    ("ws://127.0.0.1:6080/", "10.0.0.0/8,192.168.0.0/16", "", None),
+    ("ws://localhost:6080/", "127.0.0.0/8", "6080", ("127.0.0.1", 6080)),
+    ("ws://h:abc/", "", "", None),
+])
+def test_allowed_target(monkeypatch, endpoint, networks, ports, expected):
+    monkeypatch.setattr(ws_resolver, "WS_ALLOWED_NETWORKS", ws_resolver._parse_networks(networks))
+    monkeypatch.setattr(ws_resolver, "WS_ALLOWED_PORTS", ws_resolver._parse_ports(ports))
+    assert allowed_target(endpoint) == expected
+
+
+def test_probe_endpoint_skips_targets_outside_allow_list(monkeypatch):
+    def connect(*args, **kwargs):
+        raise AssertionError("probe must not connect")
+
+    monkeypatch.setattr(ws_resolver, "WS_ALLOWED_NETWORKS", ws_resolver._parse_networks("10.0.0.0/8"))
+    monkeypatch.setattr(ws_resolver.socket, "create_connection", connect)
+    assert probe_endpoint("ws://127.0.0.1:6080/websockify") is False
+
+
+def test_probe_endpoint_against_fake_websockify(monkeypatch, fake_websockify):
+    monkeypatch.setattr(ws_resolver, "WS_ALLOWED_PORTS", [])
+    port = fake_websockify(width=64, height=64)
+    assert probe_endpoint(f"ws://127.0.0.1:{port}/websockify", 1.0) is True
+    assert probe_endpoint(f"ws://127.0.0.1:{port + 1}/", 0.5) is False
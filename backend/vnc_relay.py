@@ -0,0 +1,466 @@
+"""
+Przekaźnik sesji VNC przez backend: kompresja permessage-deflate, ograniczanie
+przepustowości i łączenie żądań aktualizacji ekranu.
+"""
+import asyncio
+import itertools
+import logging
+import os
+import socket
+import struct
+import time
+import zlib
+from typing import Dict, List, Optional, Tuple
+
+import rfb_protocol as rfb
+
+logger = logging.getLogger(__name__)
+
+# Bandwidth caps in bytes/s towards the browser (0 = unlimited)
+RELAY_SESSION_RATE = int(os.getenv("RELAY_SESSION_RATE", "0"))
+RELAY_USER_RATE = int(os.getenv("RELAY_USER_RATE", "0"))
+# Bucket size, i.e. how much may be sent in one burst before shaping kicks in
+RELAY_BURST_SECONDS = float(os.getenv("RELAY_BURST_SECONDS", "0.25"))
+# Queued bytes at which the client counts as "behind" and update requests are coalesced
+RELAY_BACKLOG_LIMIT = int(os.getenv("RELAY_BACKLOG_LIMIT", str(512 * 1024)))
+# Queued bytes at which reading from the VNC server is paused altogether
+RELAY_BACKLOG_MAX = int(os.getenv("RELAY_BACKLOG_MAX", str(8 * 1024 * 1024)))
+RELAY_CONNECT_TIMEOUT = float(os.getenv("RELAY_CONNECT_TIMEOUT", "5"))
+# Compress every Nth frame to estimate the deflate ratio (1 = every frame, exact but doubles CPU)
+RELAY_DEFLATE_SAMPLE = int(os.getenv("RELAY_DEFLATE_SAMPLE", "8"))
+
+# Browsers cannot set headers on WebSocket connections, and query strings end
+# up in access logs, so the JWT travels as a Sec-WebSocket-Protocol entry
+TOKEN_SUBPROTOCOL_PREFIX = "auth."
+
+# Extension client messages noVNC may send: type -> fixed size
+EXTENSION_MESSAGE_SIZES = {
+    150: 10,  # EnableContinuousUpdates
+    250: 4,   # xvp
+}
+CLIENT_FENCE = 248
+SET_DESKTOP_SIZE = 251
+QEMU_CLIENT_MESSAGE = 255
+QEMU_EXTENDED_KEY_EVENT = 0
+
+
+class TokenBucket:
+    """
+    Token bucket shaper. ``consume`` may overdraw the bucket so that a frame
+    larger than the burst size is still sent whole; the caller then waits
+    until the debt is paid back at ``rate``.
+    """
+
+    def __init__(self, rate: int, burst: Optional[int] = None):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(int(rate * RELAY_BURST_SECONDS), 64 * 1024)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def consume(self, amount: int) -> float:
+        """Take ``amount`` tokens and return how long the caller was held back."""
+        if self.rate <= 0:
+            return 0.0
+        self._refill()
+        self.tokens -= amount
+        if self.tokens >= 0:
+            return 0.0
+        delay = -self.tokens / self.rate
+        await asyncio.sleep(delay)
+        return delay
+
+
+class DeflateEstimator:
+    """
+    Estimates the bytes permessage-deflate puts on the wire, which Starlette
+    does not expose.
+
+    Every ``sample``-th message is compressed with the settings uvicorn uses
+    (zlib defaults, 15-bit window, context takeover) and the running ratio
+    is applied to the others. Compressing a sample costs as much CPU as the
+    real compression, hence the sampling and running large frames off the
+    event loop; the compressor only sees sampled messages, so with
+    ``sample > 1`` the ratio is an approximation.
+    """
+
+    OFFLOAD_SIZE = 64 * 1024
+
+    def __init__(self, sample: int = RELAY_DEFLATE_SAMPLE):
+        self.sample = max(1, sample)
+        self._compressor = zlib.compressobj(wbits=-15)
+        self._count = 0
+        self._sampled_raw = 0
+        self._sampled_compressed = 0
+
+    def _compress(self, data: bytes) -> int:
+        compressed = self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+        # Per RFC 7692 the trailing 0x00 0x00 0xff 0xff is stripped from every message
+        return len(compressed) - 4
+
+    async def compressed_size(self, data: bytes) -> int:
+        self._count += 1
+        if (self._count - 1) % self.sample == 0:
+            if len(data) >= self.OFFLOAD_SIZE:
+                size = await asyncio.to_thread(self._compress, data)
+            else:
+                size = self._compress(data)
+            self._sampled_raw += len(data)
+            self._sampled_compressed += size
+            return size
+        return max(1, round(len(data) * self._sampled_compressed / max(self._sampled_raw, 1)))
+
+
+class ClientMessageParser:
+    """
+    Splits the browser -> VNC server byte stream into RFB messages so that
+    framebuffer update requests can be held back and merged.
+
+    Anything the parser does not understand (RFB 3.3, security types other
+    than None/VNC auth, unknown extensions) switches it to passthrough for
+    the rest of the session; the relay then just forwards bytes.
+    """
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._state = "version"
+        self.passthrough = False
+
+    def feed(self, data: bytes) -> List[Tuple[str, object]]:
+        """Return ``("data", bytes)`` chunks and ``("update_request", (incremental, x, y, w, h))`` items."""
+        if self.passthrough:
+            return [("data", data)]
+        self._buffer += data
+        items: List[Tuple[str, object]] = []
+        while not self.passthrough:
+            size = self._next_size()
+            if size is None or len(self._buffer) < size:
+                break
+            message = bytes(self._buffer[:size])
+            del self._buffer[:size]
+            if self._state == "messages" and message[0] == rfb.CLIENT_FRAMEBUFFER_UPDATE_REQUEST:
+                items.append(("update_request", struct.unpack(">xBHHHH", message)))
+            else:
+                items.append(("data", message))
+            self._advance(message)
+        if self.passthrough and self._buffer:
+            items.append(("data", bytes(self._buffer)))
+            self._buffer.clear()
+        return items
+
+    def _next_size(self) -> Optional[int]:
+        """Size of the next complete message, or None if more bytes are needed."""
+        if self._state == "version":
+            return 12
+        if self._state == "security":
+            return 1
+        if self._state == "auth":
+            return 16
+        if self._state == "client_init":
+            return 1
+        if not self._buffer:
+            return None
+
+        message_type = self._buffer[0]
+        if message_type in rfb.CLIENT_MESSAGE_SIZES:
+            return rfb.CLIENT_MESSAGE_SIZES[message_type]
+        if message_type in EXTENSION_MESSAGE_SIZES:
+            return EXTENSION_MESSAGE_SIZES[message_type]
+        if message_type == rfb.CLIENT_SET_ENCODINGS:
+            if len(self._buffer) < 4:
+                return None
+            return 4 + 4 * struct.unpack(">H", self._buffer[2:4])[0]
+        if message_type == rfb.CLIENT_CUT_TEXT:
+            if len(self._buffer) < 8:
+                return None
+            # A negative length announces an extended clipboard message of abs(length) bytes
+            return 8 + abs(struct.unpack(">i", self._buffer[4:8])[0])
+        if message_type == CLIENT_FENCE:
+            if len(self._buffer) < 9:
+                return None
+            return 9 + self._buffer[8]
+        if message_type == SET_DESKTOP_SIZE:
+            if len(self._buffer) < 8:
+                return None
+            return 8 + 16 * self._buffer[6]
+        if message_type == QEMU_CLIENT_MESSAGE:
+            if len(self._buffer) < 2:
+                return None
+            if self._buffer[1] == QEMU_EXTENDED_KEY_EVENT:
+                return 12
+        self.passthrough = True
+        return None
+
+    def _advance(self, message: bytes):
+        if self._state == "version":
+            if message[:11] >= b"RFB 003.007":
+                self._state = "security"
+            else:
+                # In RFB 3.3 the server picks the security type, so we cannot follow it
+                self.passthrough = True
+        elif self._state == "security":
+            if message[0] == rfb.SECURITY_NONE:
+                self._state = "client_init"
+            elif message[0] == rfb.SECURITY_VNC_AUTH:
+                self._state = "auth"
+            else:
+                self.passthrough = True
+        elif self._state == "auth":
+            self._state = "client_init"
+        elif self._state == "client_init":
+            self._state = "messages"
+
+
+def merge_update_requests(first: tuple, second: tuple) -> tuple:
+    """Bounding box of two update requests; a full refresh wins over incremental."""
+    incremental = first[0] and second[0]
+    x = min(first[1], second[1])
+    y = min(first[2], second[2])
+    right = max(first[1] + first[3], second[1] + second[3])
+    bottom = max(first[2] + first[4], second[2] + second[4])
+    return (incremental, x, y, right - x, bottom - y)
+
+
+class RelayStats:
+    def __init__(self, session_id: int, machine_id: int, user_id: int, username: str, upstream: str, deflate: bool):
+        self.session_id = session_id
+        self.machine_id = machine_id
+        self.user_id = user_id
+        self.username = username
+        self.upstream = upstream
+        self.deflate = deflate
+        self.started_at = time.time()
+        self.bytes_to_client = 0
+        self.compressed_bytes_to_client = 0
+        self.bytes_to_server = 0
+        self.messages_to_client = 0
+        self.queue_delay_total = 0.0
+        self.queue_delay_max = 0.0
+        self.throttled_seconds = 0.0
+        self.update_requests = 0
+        self.update_requests_deferred = 0
+        self.update_requests_coalesced = 0
+        self.backlog_bytes = 0
+
+    def as_dict(self) -> dict:
+        elapsed = max(time.time() - self.started_at, 1e-6)
+        return {
+            "session_id": self.session_id,
+            "machine_id": self.machine_id,
+            "user_id": self.user_id,
+            "username": self.username,
+            "upstream": self.upstream,
+            "deflate": self.deflate,
+            "duration_seconds": elapsed,
+            "bytes_to_client": self.bytes_to_client,
+            # Without deflate nothing is compressed, so there is no ratio to report
+            "compressed_bytes_to_client": self.compressed_bytes_to_client if self.deflate else None,
+            "compression_ratio": (
+                self.bytes_to_client / self.compressed_bytes_to_client
+                if self.deflate and self.compressed_bytes_to_client else None
+            ),
+            "bytes_to_server": self.bytes_to_server,
+            "client_bytes_per_second": self.compressed_bytes_to_client / elapsed,
+            "queue_delay_avg_ms": (
+                self.queue_delay_total / self.messages_to_client * 1000
+                if self.messages_to_client else 0.0
+            ),
+            "queue_delay_max_ms": self.queue_delay_max * 1000,
+            "throttled_seconds": self.throttled_seconds,
+            "update_requests": self.update_requests,
+            "update_requests_deferred": self.update_requests_deferred,
+            "update_requests_coalesced": self.update_requests_coalesced,
+            "backlog_bytes": self.backlog_bytes,
+        }
+
+
+class RelayRegistry:
+    """Active relay sessions and the per-user buckets they share."""
+
+    def __init__(self):
+        self.sessions: Dict[int, RelayStats] = {}
+        self._user_buckets: Dict[int, Tuple[TokenBucket, int]] = {}
+        self._ids = itertools.count(1)
+
+    def open(self, stats_args: dict) -> Tuple[RelayStats, Optional[TokenBucket]]:
+        stats = RelayStats(next(self._ids), **stats_args)
+        self.sessions[stats.session_id] = stats
+        bucket = None
+        if RELAY_USER_RATE > 0:
+            bucket, count = self._user_buckets.get(stats.user_id, (None, 0))
+            bucket = bucket or TokenBucket(RELAY_USER_RATE)
+            self._user_buckets[stats.user_id] = (bucket, count + 1)
+        return stats, bucket
+
+    def close(self, stats: RelayStats):
+        self.sessions.pop(stats.session_id, None)
+        if stats.user_id in self._user_buckets:
+            bucket, count = self._user_buckets[stats.user_id]
+            if count <= 1:
+                del self._user_buckets[stats.user_id]
+            else:
+                self._user_buckets[stats.user_id] = (bucket, count - 1)
+
+
+registry = RelayRegistry()
+
+
+def token_from_subprotocols(subprotocols: List[str]) -> str:
+    for subprotocol in subprotocols:
+        if subprotocol.startswith(TOKEN_SUBPROTOCOL_PREFIX):
+            return subprotocol[len(TOKEN_SUBPROTOCOL_PREFIX):]
+    return ""
+
+
+_unknown_server_warned = False
+
+
+async def negotiated_deflate(websocket) -> bool:
+    """
+    Whether permessage-deflate was actually negotiated on an accepted
+    connection. ASGI does not report extensions, so this asks uvicorn's
+    websockets protocol (``--ws websockets``), which Starlette holds as the
+    receive callable. Under any other server it warns once and reports
+    False, so shaping and stats then count uncompressed bytes.
+    """
+    global _unknown_server_warned
+    protocol = getattr(getattr(websocket, "_receive", None), "__self__", None)
+    if not hasattr(protocol, "extensions"):
+        if not _unknown_server_warned:
+            _unknown_server_warned = True
+            logger.warning(
+                "Cannot tell whether permessage-deflate was negotiated; run uvicorn with "
+                "--ws websockets. Relay shaping and stats assume uncompressed traffic."
+            )
+        return False
+    # accept() returns before uvicorn has finished writing the handshake response
+    handshake_completed = getattr(protocol, "handshake_completed_event", None)
+    if handshake_completed is not None:
+        try:
+            await asyncio.wait_for(handshake_completed.wait(), RELAY_CONNECT_TIMEOUT)
+        except asyncio.TimeoutError:
+            return False
+    return any(getattr(extension, "name", None) == "permessage-deflate" for extension in protocol.extensions)
+
+
+async def connect_upstream(endpoint: str, target: Tuple[str, int]):
+    """
+    Open the WebSocket connection to the VNC server at ``endpoint``, over a
+    socket connected to ``target`` as checked by ``ws_resolver.allowed_target``.
+    """
+    import websockets
+    sock = await asyncio.to_thread(socket.create_connection, target, RELAY_CONNECT_TIMEOUT)
+    try:
+        return await websockets.connect(
+            endpoint,
+            sock=sock,
+            subprotocols=["binary"],
+            compression=None,
+            max_size=None,
+            open_timeout=RELAY_CONNECT_TIMEOUT,
+        )
+    except BaseException:
+        sock.close()
+        raise
+
+
+async def relay_session(websocket, upstream, stats: RelayStats, user_bucket: Optional[TokenBucket]):
+    """
+    Pump bytes between the browser (Starlette WebSocket) and the VNC
+    server (websockets client) until either side closes.
+    """
+    import websockets
+    from starlette.websockets import WebSocketDisconnect
+
+    session_bucket = TokenBucket(RELAY_SESSION_RATE)
+    estimator = DeflateEstimator() if stats.deflate else None
+    parser = ClientMessageParser()
+    queue: asyncio.Queue = asyncio.Queue()
+    drained = asyncio.Event()
+    drained.set()
+    pending_request: List[Optional[tuple]] = [None]
+    client_closed = asyncio.Event()
+
+    async def send_upstream(data: bytes):
+        stats.bytes_to_server += len(data)
+        await upstream.send(data)
+
+    async def flush_pending_request():
+        if pending_request[0] is not None and stats.backlog_bytes < RELAY_BACKLOG_LIMIT:
+            request, pending_request[0] = pending_request[0], None
+            await send_upstream(rfb.pack_update_request(*request))
+
+    async def server_to_queue():
+        async for message in upstream:
+            if isinstance(message, str):
+                message = message.encode("latin-1")
+            stats.backlog_bytes += len(message)
+            queue.put_nowait((time.monotonic(), message))
+            if stats.backlog_bytes >= RELAY_BACKLOG_MAX:
+                drained.clear()
+                await drained.wait()
+
+    async def queue_to_client():
+        while True:
+            enqueued, message = await queue.get()
+            size = await estimator.compressed_size(message) if estimator else len(message)
+            waited = await session_bucket.consume(size)
+            if user_bucket:
+                waited += await user_bucket.consume(size)
+            stats.throttled_seconds += waited
+            await websocket.send_bytes(message)
+
+            delay = time.monotonic() - enqueued
+            stats.queue_delay_total += delay
+            stats.queue_delay_max = max(stats.queue_delay_max, delay)
+            stats.messages_to_client += 1
+            stats.bytes_to_client += len(message)
+            stats.compressed_bytes_to_client += size
+            stats.backlog_bytes -= len(message)
+            if stats.backlog_bytes < RELAY_BACKLOG_MAX:
+                drained.set()
+            await flush_pending_request()
+
+    async def client_to_server():
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                client_closed.set()
+                return
+            data = message.get("bytes")
+            if data is None:
+                data = (message.get("text") or "").encode("latin-1")
+            for kind, item in parser.feed(data):
+                if kind == "data":
+                    await send_upstream(item)
+                    continue
+                stats.update_requests += 1
+                if pending_request[0] is not None:
+                    stats.update_requests_coalesced += 1
+                    pending_request[0] = merge_update_requests(pending_request[0], item)
+                else:
+                    pending_request[0] = item
+                await flush_pending_request()
+                if pending_request[0] is not None:
+                    stats.update_requests_deferred += 1
+
+    tasks = [
+        asyncio.ensure_future(server_to_queue()),
+        asyncio.ensure_future(queue_to_client()),
+        asyncio.ensure_future(client_to_server()),
+    ]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            error = task.exception()
+            # Sends racing the browser's disconnect fail with RuntimeError; that is a normal close
+            if error and not client_closed.is_set() and not isinstance(error, (websockets.ConnectionClosed, WebSocketDisconnect, ConnectionError)):
+                logger.warning(f"Relay session {stats.session_id} failed: {error!r}")
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
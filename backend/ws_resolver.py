@@ -0,0 +1,338 @@
+"""
+Wykrywanie i zapamiętywanie działającego endpointu WebSocket dla adresu maszyny VNC.
+"""
+import base64
+import ipaddress
+import logging
+import os
+import socket
+import ssl
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
+from urllib.parse import parse_qs, urlsplit
+
+logger = logging.getLogger(__name__)
+
+WS_PROBE_TIMEOUT = float(os.getenv("WS_PROBE_TIMEOUT", "1.0"))
+WS_ENDPOINT_TTL = float(os.getenv("WS_ENDPOINT_TTL", "300"))
+# Unreachable machines are retried sooner than working ones expire
+WS_ENDPOINT_FAILURE_TTL = float(os.getenv("WS_ENDPOINT_FAILURE_TTL", "30"))
+WS_PROBE_WORKERS = int(os.getenv("WS_PROBE_WORKERS", "32"))
+# Re-probe requests for an entry younger than this are ignored
+WS_REFRESH_MIN_AGE = float(os.getenv("WS_REFRESH_MIN_AGE", "10"))
+
+
+def _parse_networks(value: str) -> List[Union[ipaddress.IPv4Network, ipaddress.IPv6Network]]:
+    return [ipaddress.ip_network(item.strip(), strict=False) for item in value.split(",") if item.strip()]
+
+
+def _parse_ports(value: str) -> List[Tuple[int, int]]:
+    ranges = []
+    for item in value.split(","):
+        if item.strip():
+            first, _, last = item.strip().partition("-")
+            ranges.append((int(first), int(last or first)))
+    return ranges
+
+
+# The backend only probes and relays to these targets, so machine URLs cannot
+# be used to reach arbitrary hosts on its network. Empty = any network / port.
+WS_ALLOWED_NETWORKS = _parse_networks(os.getenv("WS_ALLOWED_NETWORKS", ""))
+WS_ALLOWED_PORTS = _parse_ports(os.getenv("WS_ALLOWED_PORTS", "80,443,5900-5999,6080-6099"))
+
+
+def _default_port(scheme: str) -> int:
+    return 443 if scheme == "wss" else 80
+
+
+def _netloc(host: str, port) -> str:
+    # urlsplit().hostname drops the brackets around IPv6 literals
+    if ":" in host and not host.startswith("["):
+        host = f"[{host}]"
+    return f"{host}:{port}"
+
+
+def _is_valid_endpoint(endpoint: str) -> bool:
+    try:
+        parts = urlsplit(endpoint)
+        parts.port  # raises ValueError for non-numeric or out-of-range ports
+    except ValueError:
+        return False
+    return bool(parts.hostname)
+
+
+def candidate_endpoints(raw_url: str) -> List[str]:
+    """
+    WebSocket endpoints that may serve a machine URL, most likely first.
+
+    Covers the same URL forms as ``buildWebSocketUrl`` in the frontend, but
+    instead of committing to one guess it lists every websockify path that
+    noVNC deployments commonly use. Candidates that do not parse (e.g. a
+    non-numeric port) are left out, so a malformed URL yields no candidates.
+    """
+    url = raw_url.strip()
+    candidates: List[str] = []
+
+    def add(candidate: str):
+        if candidate not in candidates and _is_valid_endpoint(candidate):
+            candidates.append(candidate)
+
+    if url.startswith("ws://") or url.startswith("wss://"):
+        add(url)
+        parts = urlsplit(url)
+        if parts.path in ("", "/"):
+            add(f"{parts.scheme}://{parts.netloc}/websockify")
+        return candidates
+
+    if url.startswith("http://") or url.startswith("https://"):
+        parts = urlsplit(url)
+        scheme = "wss" if parts.scheme == "https" else "ws"
+        query = parse_qs(parts.query)
+        target_host = query.get("host", [None])[0]
+        target_port = query.get("port", [None])[0]
+        path = query.get("path", [None])[0]
+
+        if target_host and target_port:
+            netloc = _netloc(target_host, target_port)
+        else:
+            try:
+                netloc = _netloc(parts.hostname, parts.port or _default_port(scheme))
+            except ValueError:
+                return candidates
+
+        if path is not None:
+            add(f"{scheme}://{netloc}/{path.lstrip('/')}")
+        # noVNC served from a sub-directory usually proxies websockify next to it
+        directory = parts.path.rsplit("/", 1)[0] if parts.path.endswith(".html") else parts.path.rstrip("/")
+        if directory:
+            add(f"{scheme}://{netloc}{directory}/websockify")
+        add(f"{scheme}://{netloc}/websockify")
+        add(f"{scheme}://{netloc}/")
+        return candidates
+
+    if ":" in url:
+        host, _, port = url.partition(":")
+        netloc = f"{host or 'localhost'}:{port or '6080'}"
+        add(f"ws://{netloc}/websockify")
+        add(f"ws://{netloc}/")
+        return candidates
+
+    host = url or "localhost"
+    add(f"ws://{host}:5900")
+    add(f"ws://{host}:6080/websockify")
+    return candidates
+
+
+def allowed_target(endpoint: str) -> Optional[Tuple[str, int]]:
+    """
+    Address and port to connect to for ``endpoint``, or None if the target
+    is outside ``WS_ALLOWED_NETWORKS`` / ``WS_ALLOWED_PORTS``. Host names are
+    resolved here and the checked address is returned, so a DNS answer
+    cannot change between the check and the connection.
+    """
+    try:
+        parts = urlsplit(endpoint)
+        host = parts.hostname
+        port = parts.port or _default_port(parts.scheme)
+    except ValueError:
+        return None
+    if not host:
+        return None
+    if WS_ALLOWED_PORTS and not any(first <= port <= last for first, last in WS_ALLOWED_PORTS):
+        return None
+    if not WS_ALLOWED_NETWORKS:
+        return host, port
+    try:
+        addresses = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+    except (OSError, UnicodeError):
+        return None
+    for *_, sockaddr in addresses:
+        address = ipaddress.ip_address(sockaddr[0].split("%", 1)[0])
+        if any(address in network for network in WS_ALLOWED_NETWORKS):
+            return sockaddr[0], port
+    return None
+
+
+def _read_status_line(sock, request: bytes) -> bytes:
+    sock.sendall(request)
+    response = b""
+    while b"\r\n" not in response and len(response) < 1024:
+        chunk = sock.recv(1024)
+        if not chunk:
+            break
+        response += chunk
+    return response.split(b"\r\n", 1)[0]
+
+
+def probe_endpoint(endpoint: str, timeout: float = WS_PROBE_TIMEOUT) -> bool:
+    """Return True if ``endpoint`` completes a WebSocket upgrade handshake."""
+    key = base64.b64encode(os.urandom(16)).decode("ascii")
+    target = allowed_target(endpoint)
+    if target is None:
+        return False
+    try:
+        parts = urlsplit(endpoint)
+        host = parts.hostname
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        request = (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {parts.netloc}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            "Sec-WebSocket-Protocol: binary\r\n"
+            "\r\n"
+        ).encode("ascii")
+
+        with socket.create_connection(target, timeout=timeout) as sock:
+            if parts.scheme == "wss":
+                # Only reachability matters here; the browser validates the certificate
+                context = ssl.create_default_context()
+                context.check_hostname = False
+                context.verify_mode = ssl.CERT_NONE
+                with context.wrap_socket(sock, server_hostname=host) as tls:
+                    status_line = _read_status_line(tls, request)
+            else:
+                status_line = _read_status_line(sock, request)
+        status = status_line.split()
+        return len(status) >= 2 and status[1] == b"101"
+    except (OSError, ssl.SSLError, ValueError, UnicodeError):
+        return False
+
+
+class WebSocketEndpointResolver:
+    """
+    Resolves and caches the working WebSocket endpoint for machine URLs.
+
+    Candidates are probed in parallel and the most likely one that answers
+    wins. Results (including "nothing answered") are cached per URL. Once an
+    entry expires its last value keeps being served while a background
+    re-probe runs, so only a URL seen for the first time blocks the caller.
+    Callers that fail to connect to a cached endpoint should call
+    :meth:`refresh` (or ``resolve(url, refresh=True)``); entries younger
+    than ``refresh_min_age`` are kept, so repeated refreshes cannot turn
+    into a stream of probes.
+    """
+
+    def __init__(
+        self,
+        timeout: float = WS_PROBE_TIMEOUT,
+        ttl: float = WS_ENDPOINT_TTL,
+        failure_ttl: float = WS_ENDPOINT_FAILURE_TTL,
+        workers: int = WS_PROBE_WORKERS,
+        probe: Callable[[str, float], bool] = probe_endpoint,
+        refresh_min_age: float = WS_REFRESH_MIN_AGE,
+    ):
+        self.timeout = timeout
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+        self.refresh_min_age = refresh_min_age
+        self.probe = probe
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ws-probe")
+        # url -> (endpoint or None, resolved_at, expires_at)
+        self._cache: Dict[str, Tuple[Optional[str], float, float]] = {}
+        # url -> [(candidate, future)] for resolutions still running
+        self._in_flight: Dict[str, List[Tuple[str, Future]]] = {}
+        self._lock = threading.Lock()
+
+    def cached(self, url: str) -> Tuple[bool, Optional[str]]:
+        """Return ``(True, endpoint)`` if a fresh (not expired) entry exists."""
+        with self._lock:
+            entry = self._cache.get(url)
+        if entry and entry[2] > time.monotonic():
+            return True, entry[0]
+        return False, None
+
+    def invalidate(self, url: str):
+        with self._lock:
+            self._cache.pop(url, None)
+
+    def refresh(self, url: str) -> bool:
+        """Drop the entry for ``url`` unless it was resolved very recently; True if dropped."""
+        with self._lock:
+            entry = self._cache.get(url)
+            if entry and time.monotonic() - entry[1] < self.refresh_min_age:
+                return False
+            self._cache.pop(url, None)
+        return True
+
+    def resolve(self, url: str, refresh: bool = False) -> Optional[str]:
+        if refresh:
+            self.refresh(url)
+        return self.resolve_many([url])[url]
+
+    def resolve_many(self, urls: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        Resolve several URLs at once. Fresh and stale cache entries are
+        returned immediately (stale ones are re-probed in the background);
+        URLs without any entry are probed in parallel and waited for.
+        """
+        resolved: Dict[str, Optional[str]] = {}
+        waiting: Dict[str, List[Tuple[str, Future]]] = {}
+        now = time.monotonic()
+        for url in urls:
+            if url in resolved or url in waiting:
+                continue
+            with self._lock:
+                entry = self._cache.get(url)
+            if entry:
+                resolved[url] = entry[0]
+                if entry[2] <= now:
+                    self._start(url)
+                continue
+            waiting[url] = self._start(url)
+
+        if waiting:
+            futures = [future for probes in waiting.values() for _, future in probes]
+            # Probes time out on their own; the margin only covers a busy pool
+            wait(futures, timeout=self.timeout * 2 + 1)
+            for url, probes in waiting.items():
+                # Probes still queued keep running and update the cache when done
+                resolved[url] = self._best(probes)
+        return resolved
+
+    def _start(self, url: str) -> List[Tuple[str, Future]]:
+        with self._lock:
+            probes = self._in_flight.get(url)
+            if probes is not None:
+                return probes
+            probes = [
+                (candidate, self._executor.submit(self.probe, candidate, self.timeout))
+                for candidate in candidate_endpoints(url)
+            ]
+            self._in_flight[url] = probes
+        if not probes:
+            self._finish(url, probes)
+        for _, future in probes:
+            future.add_done_callback(lambda _, url=url, probes=probes: self._finish(url, probes))
+        return probes
+
+    @staticmethod
+    def _best(probes: List[Tuple[str, Future]]) -> Optional[str]:
+        """Most likely candidate that has answered so far."""
+        for candidate, future in probes:
+            if future.done() and not future.cancelled() and future.exception() is None and future.result():
+                return candidate
+        return None
+
+    def _finish(self, url: str, probes: List[Tuple[str, Future]]):
+        """Cache the result once every probe of a resolution has completed."""
+        if not all(future.done() for _, future in probes):
+            return
+        endpoint = self._best(probes)
+        with self._lock:
+            if self._in_flight.get(url) is not probes:
+                return  # another callback already stored this resolution
+            del self._in_flight[url]
+            now = time.monotonic()
+            self._cache[url] = (endpoint, now, now + (self.ttl if endpoint else self.failure_ttl))
+        if endpoint is None:
+            logger.info(f"No WebSocket endpoint found for {url}")
+
+
+resolver = WebSocketEndpointResolver()
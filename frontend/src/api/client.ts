@@ -13,7 +13,7 @@ const getApiUrl = () => {
   return apiUrl;
 };
 
-const API_URL = getApiUrl();
+export const API_URL = getApiUrl();
 
 const apiClient = axios.create({
   baseURL: API_URL,
@@ -1,4 +1,4 @@
-import apiClient from './client';
+import apiClient, { API_URL } from './client';
 
 export interface VNCMachine {
   id: number;
@@ -9,6 +9,7 @@ export interface VNCMachine {
   is_shared: boolean;
   created_at: string;
   updated_at?: string;
+  ws_url?: string | null;
 }
 
 export interface VNCMachineCreate {
@@ -54,5 +55,21 @@ export const machinesAPI = {
   delete: async (id: number): Promise<void> => {
     await apiClient.delete(`/api/machines/${id}`);
   },
+
+  refreshEndpoint: async (id: number): Promise<VNCMachine> => {
+    const response = await apiClient.post(`/api/machines/${id}/ws-endpoint/refresh`);
+    return response.data;
+  },
+
+  // WebSocket URL of the backend relay (compression and bandwidth shaping)
+  relayUrl: (id: number): string => {
+    return `${API_URL.replace(/^http/, 'ws')}/api/machines/${id}/relay`;
+  },
+
+  // Relay authentication, see TOKEN_SUBPROTOCOL_PREFIX in backend/vnc_relay.py
+  relayProtocols: (): string[] => {
+    const token = localStorage.getItem('token') || '';
+    return ['binary', `auth.${token}`];
+  },
 };
 
@@ -1,11 +1,14 @@
 import React, { useEffect, useRef, useState } from 'react';
 import RFB from 'novnc-core/src/rfb';
 import 'novnc-core/src/style.css';
+import { machinesAPI } from '../api/machines';
 import './VNCViewer.css';
 
 interface VNCViewerProps {
   url: string;
   machineName: string;
+  machineId?: number;
+  wsUrl?: string | null; // Endpoint resolved by the backend, if any
   onClose?: () => void;
 }
 
@@ -57,18 +60,20 @@ const buildWebSocketUrl = (rawUrl: string): string => {
   return `${wsProtocol}://${host}:${port}`;
 };
 
-const VNCViewer: React.FC<VNCViewerProps> = ({ url, machineName, onClose }) => {
+const VNCViewer: React.FC<VNCViewerProps> = ({ url, machineName, machineId, wsUrl: resolvedWsUrl, onClose }) => {
   const screenRef = useRef<HTMLDivElement>(null);
   const rfbRef = useRef<any>(null);
   const [connected, setConnected] = useState(false);
   const [status, setStatus] = useState('Łączenie...');
+  const [relay, setRelay] = useState(localStorage.getItem('vncRelay') === 'true');
 
   useEffect(() => {
     if (!screenRef.current) return;
+    let cancelled = false;
 
-    const connectToVNC = async () => {
+    const connectToVNC = async (wsUrl: string, canRetry: boolean, wsProtocols?: string[]) => {
       try {
-        const wsUrl = buildWebSocketUrl(url);
+        let wasConnected = false;
         console.log('Connecting to WebSocket URL:', wsUrl);
         setStatus(`Łączenie z ${wsUrl}...`);
         
@@ -77,9 +82,11 @@ const VNCViewer: React.FC<VNCViewerProps> = ({ url, machineName, onClose }) => {
           credentials: {
             password: '', // Add if needed
           },
+          ...(wsProtocols ? { wsProtocols } : {}),
         });
 
         rfb.addEventListener('connect', () => {
+          wasConnected = true;
           setConnected(true);
           setStatus('Połączono');
           console.log('VNC connected successfully');
@@ -90,6 +97,18 @@ const VNCViewer: React.FC<VNCViewerProps> = ({ url, machineName, onClose }) => {
           const reason = e.detail?.reason || 'Nieznany błąd';
           setStatus(`Rozłączono: ${e.detail?.clean ? 'Normalne rozłączenie' : reason}`);
           console.log('VNC disconnected:', e.detail);
+
+          // The endpoint may have moved since it was resolved - ask the backend to re-probe once
+          if (!wasConnected && canRetry && machineId !== undefined && !cancelled) {
+            machinesAPI.refreshEndpoint(machineId)
+              .then((machine) => {
+                const nextWsUrl = machine.ws_url || buildWebSocketUrl(url);
+                if (!cancelled && nextWsUrl !== wsUrl) {
+                  connectToVNC(nextWsUrl, false);
+                }
+              })
+              .catch((error) => console.error('Error refreshing WebSocket endpoint:', error));
+          }
         });
 
         rfb.addEventListener('credentialsrequired', () => {
@@ -115,15 +134,25 @@ const VNCViewer: React.FC<VNCViewerProps> = ({ url, machineName, onClose }) => {
       }
     };
 
-    connectToVNC();
+    if (relay && machineId !== undefined) {
+      connectToVNC(machinesAPI.relayUrl(machineId), false, machinesAPI.relayProtocols());
+    } else {
+      connectToVNC(resolvedWsUrl || buildWebSocketUrl(url), true);
+    }
 
     return () => {
+      cancelled = true;
       if (rfbRef.current) {
         rfbRef.current.disconnect();
         rfbRef.current = null;
       }
     };
-  }, [url]);
+  }, [url, resolvedWsUrl, machineId, relay]);
+
+  const handleRelayChange = (enabled: boolean) => {
+    localStorage.setItem('vncRelay', String(enabled));
+    setRelay(enabled);
+  };
 
   const handleDisconnect = () => {
     if (rfbRef.current) {
@@ -143,6 +172,16 @@ const VNCViewer: React.FC<VNCViewerProps> = ({ url, machineName, onClose }) => {
           <span className={`status-indicator ${connected ? 'connected' : 'disconnected'}`}></span>
           <span>{status}</span>
         </div>
+        {machineId !== undefined && (
+          <label className="vnc-relay-toggle" title="Kompresja i ograniczanie przepustowości przez backend (wolne łącza)">
+            <input
+              type="checkbox"
+              checked={relay}
+              onChange={(e) => handleRelayChange(e.target.checked)}
+            />
+            Przez serwer
+          </label>
+        )}
         {onClose && (
           <button className="btn-close" onClick={handleDisconnect}>
             ✕
@@ -150,6 +150,8 @@ const Dashboard: React.FC = () => {
               >
                 <VNCViewer
                   url={tab.machine.url}
+                  wsUrl={tab.machine.ws_url}
+                  machineId={tab.machine.id}
                   machineName={tab.machine.name}
                   onClose={() => handleCloseVncTab(tab.id)}
                 />